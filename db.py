@@ -1,8 +1,20 @@
+import base64
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+
 import aiosqlite
+from aiosqlitepool import SQLiteConnectionPool
 from pathlib import Path
 
 DB_DIR = Path(__file__).parent / "data"
 DB_PATH = DB_DIR / "chat.db"
+IMAGE_URL_PREFIX = "/api/images/"
+
+log = logging.getLogger(__name__)
+POOL_SIZE = 8
+MAX_SORT_ORDER = 2**63 - 1
+STATEMENT_CACHE_SIZE = 256
 
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS conversations (
@@ -26,10 +38,17 @@ CREATE TABLE IF NOT EXISTS messages (
     cost            REAL
 );
 
+CREATE TABLE IF NOT EXISTS image_blobs (
+    hash TEXT PRIMARY KEY,
+    mime TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+
 CREATE TABLE IF NOT EXISTS message_images (
     id         INTEGER PRIMARY KEY AUTOINCREMENT,
     message_id INTEGER NOT NULL REFERENCES messages(id) ON DELETE CASCADE,
-    data_url   TEXT NOT NULL
+    blob_hash  TEXT NOT NULL,
+    mime       TEXT NOT NULL
 );
 
 CREATE TABLE IF NOT EXISTS system_prompts (
@@ -49,31 +68,191 @@ CREATE TABLE IF NOT EXISTS endpoints (
     api_format                TEXT NOT NULL DEFAULT 'responses',
     created_at                TEXT NOT NULL DEFAULT (datetime('now'))
 );
+
+CREATE INDEX IF NOT EXISTS idx_messages_conv_order ON messages(conversation_id, sort_order);
+CREATE INDEX IF NOT EXISTS idx_images_msg ON message_images(message_id);
+CREATE INDEX IF NOT EXISTS idx_images_blob ON message_images(blob_hash);
+CREATE INDEX IF NOT EXISTS idx_conv_updated ON conversations(updated_at DESC);
 """
 
+# Applied to every pooled connection; journal_mode is persistent and set in init_db
+PRAGMAS = """
+PRAGMA foreign_keys = ON;
+PRAGMA synchronous = NORMAL;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -20000;
+PRAGMA mmap_size = 268435456;
+PRAGMA busy_timeout = 5000;
+PRAGMA wal_autocheckpoint = 1000;
+"""
+
+
+_pool = None
+
+
+async def _connect():
+    db = await aiosqlite.connect(DB_PATH, cached_statements=STATEMENT_CACHE_SIZE)
+    await db.executescript(PRAGMAS)
+    db.row_factory = aiosqlite.Row
+    return db
+
+
+def open_pool():
+    global _pool
+    DB_DIR.mkdir(parents=True, exist_ok=True)
+    _pool = SQLiteConnectionPool(_connect, pool_size=POOL_SIZE)
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
 
 def _db():
-    return aiosqlite.connect(DB_PATH)
+    return _pool.connection()
+
+
+@asynccontextmanager
+async def transaction():
+    """Check out a pooled connection and run the block as one write transaction.
+
+    Mutating functions below take this connection as their first argument and
+    leave committing to the caller, so a whole request costs a single commit.
+    """
+    async with _db() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+
+
+def parse_image(url):
+    """Split an image URL into (hash, mime, data); data is None for already stored images."""
+    if not isinstance(url, str):
+        raise ValueError("expected an image URL string")
+    if url.startswith(IMAGE_URL_PREFIX):
+        return url[len(IMAGE_URL_PREFIX):], None, None
+    header, sep, payload = url.partition(",")
+    if not header.startswith("data:") or not header.endswith(";base64") or not sep:
+        raise ValueError("expected a base64 data URL")
+    mime = header[len("data:"):-len(";base64")].split(";")[0].strip().lower()
+    # Stored images are served from our own origin, so nothing that a browser would render as a document
+    if not mime.startswith("image/") or mime == "image/svg+xml":
+        raise ValueError("expected an image data URL")
+    data = base64.b64decode(payload, validate=True)
+    return hashlib.sha256(data).hexdigest(), mime, data
+
+
+async def _store_images(db, msg_id, parsed):
+    await db.executemany(
+        "INSERT OR IGNORE INTO image_blobs (hash, mime, data) VALUES (?, ?, ?)",
+        [(h, mime, data) for h, mime, data in parsed if data is not None],
+    )
+    cursor = await db.executemany(
+        "INSERT INTO message_images (message_id, blob_hash, mime) "
+        "SELECT ?, hash, mime FROM image_blobs WHERE hash = ?",
+        [(msg_id, h) for h, _, _ in parsed],
+    )
+    # Only a reference to an already stored image can miss here
+    if cursor.rowcount != len(parsed):
+        raise ValueError("unknown image")
+
+
+async def _create_schema(db):
+    # Statement by statement rather than executescript, which would commit mid-migration
+    for statement in SCHEMA.split(";"):
+        if statement.strip():
+            await db.execute(statement)
+
+
+async def _add_reasoning_tokens(db):
+    await db.execute("ALTER TABLE messages ADD COLUMN reasoning_tokens INTEGER NOT NULL DEFAULT 0")
+
+
+async def _move_images_to_blobs(db):
+    await db.execute("DROP INDEX IF EXISTS idx_images_msg")
+    await db.execute("ALTER TABLE message_images RENAME TO message_images_legacy")
+    await _create_schema(db)
+    # Iterate rather than fetchall: the legacy rows are the full base64 image payloads
+    cursor = await db.execute("SELECT id, message_id, data_url FROM message_images_legacy ORDER BY id")
+    async for image_id, message_id, data_url in cursor:
+        # Old rows held whatever string the client sent; drop the ones that are not images
+        try:
+            parsed = parse_image(data_url)
+        except ValueError:
+            parsed = None
+        if parsed is None or parsed[2] is None:
+            log.warning("Dropping unreadable image %d of message %d", image_id, message_id)
+            continue
+        await _store_images(db, message_id, [parsed])
+    await db.execute("DROP TABLE message_images_legacy")
+
+
+# (version, migration) pairs; each one brings the schema from the previous version up to its own
+MIGRATIONS = [
+    (1, _add_reasoning_tokens),
+    (2, _move_images_to_blobs),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def _unversioned_schema_version(db):
+    """Infer the version of a database created before user_version was tracked."""
+    cursor = await db.execute("PRAGMA table_info(messages)")
+    columns = {row[1] for row in await cursor.fetchall()}
+    if not columns:
+        return SCHEMA_VERSION  # brand new database, _create_schema builds it in full
+    cursor = await db.execute("PRAGMA table_info(message_images)")
+    if "data_url" not in {row[1] for row in await cursor.fetchall()}:
+        return 2
+    return 1 if "reasoning_tokens" in columns else 0
+
+
+async def _prune_image_blobs(db, hashes):
+    # Blobs are shared by content hash, so drop one only once no message refers to it
+    await db.executemany(
+        "DELETE FROM image_blobs WHERE hash = ? "
+        "AND NOT EXISTS (SELECT 1 FROM message_images WHERE blob_hash = ?)",
+        [(h, h) for h in hashes],
+    )
 
 
 async def init_db():
-    DB_DIR.mkdir(parents=True, exist_ok=True)
     async with _db() as db:
-        await db.execute("PRAGMA foreign_keys = ON")
-        await db.executescript(SCHEMA)
-        # Migrations
-        cursor = await db.execute("PRAGMA table_info(messages)")
-        columns = {row[1] for row in await cursor.fetchall()}
-        if "reasoning_tokens" not in columns:
-            await db.execute("ALTER TABLE messages ADD COLUMN reasoning_tokens INTEGER NOT NULL DEFAULT 0")
+        await db.execute("PRAGMA journal_mode = WAL")
+        cursor = await db.execute("PRAGMA user_version")
+        (version,) = await cursor.fetchone()
+        if version >= SCHEMA_VERSION:
+            return
+        await db.execute("BEGIN IMMEDIATE")
+        if version == 0:
+            version = await _unversioned_schema_version(db)
+        for target, migrate in MIGRATIONS:
+            if target > version:
+                await migrate(db)
+        await _create_schema(db)
+        await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         await db.commit()
+        # Refresh planner statistics for the new schema; PRAGMA optimize keeps them current afterwards
+        await db.execute("ANALYZE")
+        await db.commit()
+
+
+async def optimize_db():
+    async with _db() as db:
+        await db.execute("PRAGMA optimize")
 
 
 # ── Conversations ──
 
 async def list_conversations():
     async with _db() as db:
-        db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT id, title, system_prompt, updated_at FROM conversations ORDER BY updated_at DESC"
         )
@@ -81,52 +260,44 @@ async def list_conversations():
         return [dict(r) for r in rows]
 
 
-async def create_conversation(title="New Chat"):
-    async with _db() as db:
-        cursor = await db.execute(
-            "INSERT INTO conversations (title) VALUES (?)", (title,)
-        )
-        await db.commit()
-        conv_id = cursor.lastrowid
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT id, title, system_prompt, created_at, updated_at FROM conversations WHERE id = ?",
-            (conv_id,),
-        )
-        row = await cursor.fetchone()
-        return dict(row)
+async def create_conversation(db, title="New Chat"):
+    cursor = await db.execute(
+        "INSERT INTO conversations (title) VALUES (?) RETURNING id, title, system_prompt, created_at, updated_at",
+        (title,),
+    )
+    row = await cursor.fetchone()
+    return dict(row)
 
 
-async def delete_conversation(conv_id):
-    async with _db() as db:
-        await db.execute("PRAGMA foreign_keys = ON")
-        await db.execute("DELETE FROM conversations WHERE id = ?", (conv_id,))
-        await db.commit()
+async def delete_conversation(db, conv_id):
+    cursor = await db.execute(
+        "SELECT DISTINCT blob_hash FROM message_images "
+        "WHERE message_id IN (SELECT id FROM messages WHERE conversation_id = ?)",
+        (conv_id,),
+    )
+    hashes = [row[0] for row in await cursor.fetchall()]
+    await db.execute("DELETE FROM conversations WHERE id = ?", (conv_id,))
+    await _prune_image_blobs(db, hashes)
 
 
-async def rename_conversation(conv_id, title):
-    async with _db() as db:
-        await db.execute(
-            "UPDATE conversations SET title = ?, updated_at = datetime('now') WHERE id = ?",
-            (title, conv_id),
-        )
-        await db.commit()
+async def rename_conversation(db, conv_id, title):
+    await db.execute(
+        "UPDATE conversations SET title = ?, updated_at = datetime('now') WHERE id = ?",
+        (title, conv_id),
+    )
 
 
-async def set_conversation_system_prompt(conv_id, text):
-    async with _db() as db:
-        await db.execute(
-            "UPDATE conversations SET system_prompt = ?, updated_at = datetime('now') WHERE id = ?",
-            (text, conv_id),
-        )
-        await db.commit()
+async def set_conversation_system_prompt(db, conv_id, text):
+    await db.execute(
+        "UPDATE conversations SET system_prompt = ?, updated_at = datetime('now') WHERE id = ?",
+        (text, conv_id),
+    )
 
 
 # ── System Prompts Library ──
 
 async def list_system_prompts():
     async with _db() as db:
-        db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT id, name, text, created_at FROM system_prompts ORDER BY name"
         )
@@ -134,110 +305,102 @@ async def list_system_prompts():
         return [dict(r) for r in rows]
 
 
-async def create_system_prompt(name, text):
-    async with _db() as db:
-        cursor = await db.execute(
-            "INSERT INTO system_prompts (name, text) VALUES (?, ?)", (name, text)
-        )
-        await db.commit()
-        prompt_id = cursor.lastrowid
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT id, name, text, created_at FROM system_prompts WHERE id = ?",
-            (prompt_id,),
-        )
-        row = await cursor.fetchone()
-        return dict(row)
+async def create_system_prompt(db, name, text):
+    cursor = await db.execute(
+        "INSERT INTO system_prompts (name, text) VALUES (?, ?) RETURNING id, name, text, created_at",
+        (name, text),
+    )
+    row = await cursor.fetchone()
+    return dict(row)
 
 
-async def delete_system_prompt(prompt_id):
-    async with _db() as db:
-        await db.execute("DELETE FROM system_prompts WHERE id = ?", (prompt_id,))
-        await db.commit()
+async def delete_system_prompt(db, prompt_id):
+    await db.execute("DELETE FROM system_prompts WHERE id = ?", (prompt_id,))
 
 
 # ── Messages ──
 
-async def get_messages(conv_id):
+async def get_messages(conv_id, before=None, limit=None):
+    """Return messages in order; with before/limit, only the latest `limit` ones below `before`."""
+    # SQLite treats a negative LIMIT as "no limit"
+    params = (conv_id, MAX_SORT_ORDER if before is None else before, -1 if limit is None else limit)
     async with _db() as db:
-        db.row_factory = aiosqlite.Row
+        # One read transaction, so both queries see the same WAL snapshot
+        await db.execute("BEGIN")
         cursor = await db.execute(
             "SELECT id, role, text, sort_order, input_tokens, output_tokens, reasoning_tokens, cost FROM messages "
-            "WHERE conversation_id = ? ORDER BY sort_order",
-            (conv_id,),
+            "WHERE conversation_id = ? AND sort_order < ? ORDER BY sort_order DESC LIMIT ?",
+            params,
         )
-        msgs = [dict(r) for r in await cursor.fetchall()]
-
+        msgs = [dict(r) for r in reversed(await cursor.fetchall())]
+        by_id = {}
         for msg in msgs:
-            cursor = await db.execute(
-                "SELECT data_url FROM message_images WHERE message_id = ?",
-                (msg["id"],),
-            )
-            msg["images"] = [row[0] for row in await cursor.fetchall()]
+            msg["images"] = []
+            by_id[msg["id"]] = msg
+
+        cursor = await db.execute(
+            "SELECT message_id, blob_hash FROM message_images "
+            "WHERE message_id IN (SELECT id FROM messages WHERE conversation_id = ? AND sort_order < ? "
+            "ORDER BY sort_order DESC LIMIT ?) ORDER BY id",
+            params,
+        )
+        for message_id, blob_hash in await cursor.fetchall():
+            msg = by_id.get(message_id)
+            if msg is not None:
+                msg["images"].append(IMAGE_URL_PREFIX + blob_hash)
+        await db.commit()
 
         return msgs
 
 
-async def delete_message(msg_id):
-    async with _db() as db:
-        await db.execute("PRAGMA foreign_keys = ON")
-        await db.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
-        await db.commit()
+async def delete_message(db, msg_id):
+    cursor = await db.execute(
+        "SELECT DISTINCT blob_hash FROM message_images WHERE message_id = ?", (msg_id,)
+    )
+    hashes = [row[0] for row in await cursor.fetchall()]
+    await db.execute("DELETE FROM messages WHERE id = ?", (msg_id,))
+    await _prune_image_blobs(db, hashes)
 
 
-async def add_message(conv_id, role, text, images=None, input_tokens=0, output_tokens=0, reasoning_tokens=0, cost=None):
-    async with _db() as db:
-        await db.execute("PRAGMA foreign_keys = ON")
+async def add_message(db, conv_id, role, text, images=(), input_tokens=0, output_tokens=0, reasoning_tokens=0, cost=None):
+    """Insert a message; `images` are parse_image() results, decoded before the transaction starts."""
+    # Next sort_order is computed in the INSERT itself and handed back via RETURNING
+    cursor = await db.execute(
+        "INSERT INTO messages (conversation_id, role, text, sort_order, input_tokens, output_tokens, reasoning_tokens, cost) "
+        "VALUES (?, ?, ?, (SELECT COALESCE(MAX(sort_order), -1) + 1 FROM messages WHERE conversation_id = ?), ?, ?, ?, ?) "
+        "RETURNING id, sort_order",
+        (conv_id, role, text, conv_id, input_tokens, output_tokens, reasoning_tokens, cost),
+    )
+    msg_id, sort_order = await cursor.fetchone()
 
-        # Determine next sort_order
-        cursor = await db.execute(
-            "SELECT COALESCE(MAX(sort_order), -1) + 1 FROM messages WHERE conversation_id = ?",
-            (conv_id,),
-        )
-        (sort_order,) = await cursor.fetchone()
+    if images:
+        await _store_images(db, msg_id, images)
 
-        cursor = await db.execute(
-            "INSERT INTO messages (conversation_id, role, text, sort_order, input_tokens, output_tokens, reasoning_tokens, cost) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (conv_id, role, text, sort_order, input_tokens, output_tokens, reasoning_tokens, cost),
-        )
-        msg_id = cursor.lastrowid
-
-        if images:
-            for data_url in images:
-                await db.execute(
-                    "INSERT INTO message_images (message_id, data_url) VALUES (?, ?)",
-                    (msg_id, data_url),
-                )
-
-        # Auto-title: if this is the first user message and title is still "New Chat"
-        if role == "user" and sort_order == 0:
-            cur = await db.execute(
-                "SELECT title FROM conversations WHERE id = ?", (conv_id,)
-            )
-            row = await cur.fetchone()
-            if row and row[0] == "New Chat" and text.strip():
-                auto_title = text.strip()[:50]
-                await db.execute(
-                    "UPDATE conversations SET title = ?, updated_at = datetime('now') WHERE id = ?",
-                    (auto_title, conv_id),
-                )
-
-        # Touch updated_at
-        await db.execute(
-            "UPDATE conversations SET updated_at = datetime('now') WHERE id = ?",
-            (conv_id,),
-        )
+    # Touch updated_at; auto-title if this is the first user message and title is still "New Chat"
+    auto_title = role == "user" and sort_order == 0 and bool(text.strip())
+    await db.execute(
+        "UPDATE conversations SET title = CASE WHEN ? AND title = 'New Chat' THEN ? ELSE title END, "
+        "updated_at = datetime('now') WHERE id = ?",
+        (auto_title, text.strip()[:50], conv_id),
+    )
+
+    image_urls = [IMAGE_URL_PREFIX + h for h, _, _ in images]
+    return {"id": msg_id, "role": role, "text": text, "images": image_urls, "sort_order": sort_order, "input_tokens": input_tokens, "output_tokens": output_tokens, "reasoning_tokens": reasoning_tokens, "cost": cost}
 
-        await db.commit()
 
-        return {"id": msg_id, "role": role, "text": text, "images": images or [], "sort_order": sort_order, "input_tokens": input_tokens, "output_tokens": output_tokens, "reasoning_tokens": reasoning_tokens, "cost": cost}
+async def get_image(blob_hash):
+    async with _db() as db:
+        cursor = await db.execute(
+            "SELECT mime, data FROM image_blobs WHERE hash = ?", (blob_hash,)
+        )
+        row = await cursor.fetchone()
+        return dict(row) if row else None
 
 
 # ── Endpoints ──
 
 async def list_endpoints():
     async with _db() as db:
-        db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT id, name, base_url, api_key, cost_per_million_input, cost_per_million_output, api_format, created_at FROM endpoints ORDER BY name"
         )
@@ -247,7 +410,6 @@ async def list_endpoints():
 
 async def get_endpoint(endpoint_id):
     async with _db() as db:
-        db.row_factory = aiosqlite.Row
         cursor = await db.execute(
             "SELECT id, name, base_url, api_key, cost_per_million_input, cost_per_million_output, api_format FROM endpoints WHERE id = ?",
             (endpoint_id,),
@@ -256,24 +418,15 @@ async def get_endpoint(endpoint_id):
         return dict(row) if row else None
 
 
-async def create_endpoint(name, base_url, api_key, cost_per_million_input=0, cost_per_million_output=0, api_format='responses'):
-    async with _db() as db:
-        cursor = await db.execute(
-            "INSERT INTO endpoints (name, base_url, api_key, cost_per_million_input, cost_per_million_output, api_format) VALUES (?, ?, ?, ?, ?, ?)",
-            (name, base_url, api_key, cost_per_million_input, cost_per_million_output, api_format),
-        )
-        await db.commit()
-        endpoint_id = cursor.lastrowid
-        db.row_factory = aiosqlite.Row
-        cursor = await db.execute(
-            "SELECT id, name, base_url, api_key, cost_per_million_input, cost_per_million_output, api_format, created_at FROM endpoints WHERE id = ?",
-            (endpoint_id,),
-        )
-        row = await cursor.fetchone()
-        return dict(row)
+async def create_endpoint(db, name, base_url, api_key, cost_per_million_input=0, cost_per_million_output=0, api_format='responses'):
+    cursor = await db.execute(
+        "INSERT INTO endpoints (name, base_url, api_key, cost_per_million_input, cost_per_million_output, api_format) VALUES (?, ?, ?, ?, ?, ?) "
+        "RETURNING id, name, base_url, api_key, cost_per_million_input, cost_per_million_output, api_format, created_at",
+        (name, base_url, api_key, cost_per_million_input, cost_per_million_output, api_format),
+    )
+    row = await cursor.fetchone()
+    return dict(row)
 
 
-async def delete_endpoint(endpoint_id):
-    async with _db() as db:
-        await db.execute("DELETE FROM endpoints WHERE id = ?", (endpoint_id,))
-        await db.commit()
+async def delete_endpoint(db, endpoint_id):
+    await db.execute("DELETE FROM endpoints WHERE id = ?", (endpoint_id,))
@@ -10,7 +10,7 @@ import asyncio
 import json
 import sys
 
-from db import init_db, create_system_prompt
+from db import open_pool, close_pool, transaction, init_db, create_system_prompt
 
 
 async def main(path):
@@ -20,15 +20,20 @@ async def main(path):
     if not isinstance(data, list):
         print("Error: expected JSON array of {name, text}", file=sys.stderr)
         sys.exit(1)
-    await init_db()
-    for item in data:
-        name = item.get("name", "").strip()
-        text = item.get("text", "").strip()
-        if not name or not text:
-            print(f"Skipped (empty name or text): {item}", file=sys.stderr)
-            continue
-        prompt = await create_system_prompt(name, text)
-        print(f"Imported: {prompt['name']} (id={prompt['id']})")
+    open_pool()
+    try:
+        await init_db()
+        async with transaction() as db:
+            for item in data:
+                name = item.get("name", "").strip()
+                text = item.get("text", "").strip()
+                if not name or not text:
+                    print(f"Skipped (empty name or text): {item}", file=sys.stderr)
+                    continue
+                prompt = await create_system_prompt(db, name, text)
+                print(f"Imported: {prompt['name']} (id={prompt['id']})")
+    finally:
+        await close_pool()
 
 
 if __name__ == "__main__":
@@ -1,176 +1,266 @@
 import asyncio
-import json
+import hashlib
+import logging
 from pathlib import Path
 
-from aiohttp import web, ClientSession, ClientTimeout
-import aiohttp_cors
+from aiohttp import web, ClientSession, ClientTimeout, TCPConnector
+import orjson
+
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
 
 from db import (
-    init_db, list_conversations, create_conversation, delete_conversation,
+    open_pool, close_pool, transaction, init_db, optimize_db,
+    list_conversations, create_conversation, delete_conversation,
     rename_conversation, set_conversation_system_prompt,
-    get_messages, add_message, delete_message,
+    get_messages, add_message, delete_message, get_image, parse_image, MAX_SORT_ORDER,
     list_system_prompts, create_system_prompt, delete_system_prompt,
-    list_endpoints, get_endpoint, create_endpoint, delete_endpoint,
+    list_endpoints, create_endpoint, delete_endpoint,
 )
 STATIC_DIR = Path(__file__).parent / "static"
 MODELS_FILE = Path(__file__).parent / "models.json"
+OPTIMIZE_INTERVAL = 15 * 60
+
+log = logging.getLogger(__name__)
+MODELS_CACHE_CONTROL = "max-age=300"
+INDEX_CACHE_CONTROL = "no-cache"
+# Static URLs are not versioned, so browsers must revalidate (FileResponse answers 304 via ETag)
+STATIC_CACHE_CONTROL = "no-cache"
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "*",
+    "Access-Control-Allow-Headers": "*",
+    "Access-Control-Expose-Headers": "*",
+}
+
+
+def json_response(data, status=200):
+    return web.Response(body=orjson.dumps(data), status=status, content_type="application/json")
+
+
+async def read_json(request):
+    return orjson.loads(await request.read())
+
+
+def cached_response(request, body, etag, content_type, cache_control):
+    """Serve in-memory bytes, answering 304 when the client already has this ETag."""
+    headers = {"Cache-Control": cache_control}
+    if any(e.value == etag for e in request.if_none_match or ()):
+        resp = web.Response(status=304, headers=headers)
+    else:
+        resp = web.Response(body=body, content_type=content_type, headers=headers)
+    resp.etag = etag
+    return resp
 
 
 async def index_handler(request):
-    return web.FileResponse(STATIC_DIR / "index.html")
+    return cached_response(
+        request, request.app["index_bytes"], request.app["index_etag"],
+        "text/html", INDEX_CACHE_CONTROL,
+    )
 
 
 async def models_handler(request):
-    with open(MODELS_FILE) as f:
-        data = json.load(f)
-    return web.json_response(data)
+    return cached_response(
+        request, request.app["models_bytes"], request.app["models_etag"],
+        "application/json", MODELS_CACHE_CONTROL,
+    )
 
 
 async def proxy_handler(request):
-    """Proxy requests to the upstream API, preserving the sub-path."""
+    """Proxy requests to the upstream API, preserving the sub-path.
+
+    Both the request and the response bodies are streamed, so SSE completions
+    reach the client as they arrive instead of after the upstream finishes.
+    """
     sub_path = request.match_info.get("path", "responses")
-    body = await request.read()
 
     endpoint_id = request.rel_url.query.get("endpoint_id")
     if not endpoint_id:
-        return web.json_response({"error": "endpoint_id query param required"}, status=400)
-    endpoint = await get_endpoint(int(endpoint_id))
+        return json_response({"error": "endpoint_id query param required"}, status=400)
+    endpoint = request.app["endpoints_cache"].get(int(endpoint_id))
     if not endpoint:
-        return web.json_response({"error": "Endpoint not found"}, status=404)
+        return json_response({"error": "Endpoint not found"}, status=404)
 
     base_url = endpoint["base_url"].rstrip("/")
     headers = {
         "Authorization": f"Bearer {endpoint['api_key']}",
         "Content-Type": "application/json",
     }
+    if request.content_length is not None:
+        headers["Content-Length"] = str(request.content_length)
 
     session: ClientSession = request.app["client_session"]
+    resp = None
     try:
         async with session.post(
             f"{base_url}/v1/{sub_path}",
-            data=body,
+            data=request.content,
             headers=headers,
         ) as upstream_resp:
-            resp_body = await upstream_resp.read()
-            return web.Response(
-                body=resp_body,
+            resp = web.StreamResponse(
                 status=upstream_resp.status,
-                content_type="application/json",
+                headers={"Content-Type": upstream_resp.headers.get("Content-Type", "application/json")},
             )
+            await resp.prepare(request)
+            async for chunk in upstream_resp.content.iter_any():
+                await resp.write(chunk)
+            await resp.write_eof()
+            return resp
     except asyncio.TimeoutError:
-        return web.json_response({"error": "Upstream request timed out"}, status=504)
+        # Headers already sent: abort the connection rather than append an error body
+        if resp is not None:
+            raise
+        return json_response({"error": "Upstream request timed out"}, status=504)
     except Exception as e:
-        return web.json_response({"error": str(e)}, status=502)
+        if resp is not None:
+            raise
+        return json_response({"error": str(e)}, status=502)
 
 
 # ── Conversation endpoints ──
 
 async def conversations_list_handler(request):
     convs = await list_conversations()
-    return web.json_response(convs)
+    return json_response(convs)
 
 
 async def conversations_create_handler(request):
-    conv = await create_conversation()
-    return web.json_response(conv, status=201)
+    async with transaction() as db:
+        conv = await create_conversation(db)
+    return json_response(conv, status=201)
 
 
 async def conversations_delete_handler(request):
     conv_id = int(request.match_info["id"])
-    await delete_conversation(conv_id)
-    return web.json_response({"ok": True})
+    async with transaction() as db:
+        await delete_conversation(db, conv_id)
+    return json_response({"ok": True})
 
 
 async def conversations_patch_handler(request):
     conv_id = int(request.match_info["id"])
-    data = await request.json()
+    data = await read_json(request)
     if "title" in data:
         title = data["title"].strip()
         if not title:
-            return web.json_response({"error": "title required"}, status=400)
-        await rename_conversation(conv_id, title)
-    if "system_prompt" in data:
-        await set_conversation_system_prompt(conv_id, data["system_prompt"])
-    return web.json_response({"ok": True})
+            return json_response({"error": "title required"}, status=400)
+    async with transaction() as db:
+        if "title" in data:
+            await rename_conversation(db, conv_id, title)
+        if "system_prompt" in data:
+            await set_conversation_system_prompt(db, conv_id, data["system_prompt"])
+    return json_response({"ok": True})
 
 
 # ── Message endpoints ──
 
 async def messages_list_handler(request):
     conv_id = int(request.match_info["id"])
-    msgs = await get_messages(conv_id)
-    return web.json_response(msgs)
+    query = request.rel_url.query
+    try:
+        before = int(query["before"]) if "before" in query else None
+        limit = int(query["limit"]) if "limit" in query else None
+    except ValueError:
+        return json_response({"error": "before and limit must be integers"}, status=400)
+    if (before is not None and abs(before) > MAX_SORT_ORDER) or (limit is not None and not 0 <= limit <= MAX_SORT_ORDER):
+        return json_response({"error": "before and limit must fit in 64 bits and limit must not be negative"}, status=400)
+    msgs = await get_messages(conv_id, before, limit)
+    return json_response(msgs)
 
 
 async def messages_create_handler(request):
     conv_id = int(request.match_info["id"])
-    data = await request.json()
+    data = await read_json(request)
     role = data.get("role", "user")
     text = data.get("text", "")
-    images = data.get("images", [])
     input_tokens = int(data.get("input_tokens", 0) or 0)
     output_tokens = int(data.get("output_tokens", 0) or 0)
     reasoning_tokens = int(data.get("reasoning_tokens", 0) or 0)
     cost = data.get("cost")
     if cost is not None:
         cost = float(cost)
-    msg = await add_message(conv_id, role, text, images, input_tokens, output_tokens, reasoning_tokens, cost)
-    return web.json_response(msg, status=201)
+    try:
+        # Decode and hash outside the transaction so the write lock isn't held for it
+        images = [parse_image(url) for url in data.get("images") or []]
+        async with transaction() as db:
+            msg = await add_message(db, conv_id, role, text, images, input_tokens, output_tokens, reasoning_tokens, cost)
+    except ValueError:
+        return json_response({"error": "images must be base64 data URLs or stored image URLs"}, status=400)
+    return json_response(msg, status=201)
 
 
 async def messages_delete_handler(request):
     msg_id = int(request.match_info["msg_id"])
-    await delete_message(msg_id)
-    return web.json_response({"ok": True})
+    async with transaction() as db:
+        await delete_message(db, msg_id)
+    return json_response({"ok": True})
+
+
+async def images_handler(request):
+    image = await get_image(request.match_info["hash"])
+    if not image:
+        return json_response({"error": "Image not found"}, status=404)
+    # Images are content-addressed, so a given URL never changes
+    return web.Response(
+        body=image["data"],
+        content_type=image["mime"],
+        headers={"Cache-Control": "public, max-age=31536000, immutable", "X-Content-Type-Options": "nosniff"},
+    )
 
 
 # ── System Prompts Library endpoints ──
 
 async def prompts_list_handler(request):
     prompts = await list_system_prompts()
-    return web.json_response(prompts)
+    return json_response(prompts)
 
 
 async def prompts_create_handler(request):
-    data = await request.json()
+    data = await read_json(request)
     name = data.get("name", "").strip()
     text = data.get("text", "").strip()
     if not name or not text:
-        return web.json_response({"error": "name and text required"}, status=400)
-    prompt = await create_system_prompt(name, text)
-    return web.json_response(prompt, status=201)
+        return json_response({"error": "name and text required"}, status=400)
+    async with transaction() as db:
+        prompt = await create_system_prompt(db, name, text)
+    return json_response(prompt, status=201)
 
 
 async def prompts_import_handler(request):
-    data = await request.json()
+    data = await read_json(request)
     if not isinstance(data, list):
-        return web.json_response({"error": "expected JSON array of {name, text}"}, status=400)
+        return json_response({"error": "expected JSON array of {name, text}"}, status=400)
     imported = []
-    for item in data:
-        name = item.get("name", "").strip()
-        text = item.get("text", "").strip()
-        if not name or not text:
-            continue
-        prompt = await create_system_prompt(name, text)
-        imported.append(prompt)
-    return web.json_response(imported, status=201)
+    async with transaction() as db:
+        for item in data:
+            name = item.get("name", "").strip()
+            text = item.get("text", "").strip()
+            if not name or not text:
+                continue
+            prompt = await create_system_prompt(db, name, text)
+            imported.append(prompt)
+    return json_response(imported, status=201)
 
 
 async def prompts_delete_handler(request):
     prompt_id = int(request.match_info["id"])
-    await delete_system_prompt(prompt_id)
-    return web.json_response({"ok": True})
+    async with transaction() as db:
+        await delete_system_prompt(db, prompt_id)
+    return json_response({"ok": True})
 
 
 # ── Endpoint endpoints ──
 
 async def endpoints_list_handler(request):
     eps = await list_endpoints()
-    return web.json_response(eps)
+    return json_response(eps)
 
 
 async def endpoints_create_handler(request):
-    data = await request.json()
+    data = await read_json(request)
     name = data.get("name", "").strip()
     base_url = data.get("base_url", "").strip()
     api_key = data.get("api_key", "").strip()
@@ -180,32 +270,73 @@ async def endpoints_create_handler(request):
     if api_format not in ("responses", "chat_completions"):
         api_format = "responses"
     if not name or not base_url:
-        return web.json_response({"error": "name and base_url required"}, status=400)
-    ep = await create_endpoint(name, base_url, api_key, cost_per_million_input, cost_per_million_output, api_format)
-    return web.json_response(ep, status=201)
+        return json_response({"error": "name and base_url required"}, status=400)
+    async with request.app["endpoints_lock"]:
+        async with transaction() as db:
+            ep = await create_endpoint(db, name, base_url, api_key, cost_per_million_input, cost_per_million_output, api_format)
+        request.app["endpoints_cache"][ep["id"]] = ep
+    return json_response(ep, status=201)
 
 
 async def endpoints_delete_handler(request):
     ep_id = int(request.match_info["id"])
-    await delete_endpoint(ep_id)
-    return web.json_response({"ok": True})
+    async with request.app["endpoints_lock"]:
+        async with transaction() as db:
+            await delete_endpoint(db, ep_id)
+        request.app["endpoints_cache"].pop(ep_id, None)
+    return json_response({"ok": True})
+
+
+async def optimize_loop():
+    while True:
+        await asyncio.sleep(OPTIMIZE_INTERVAL)
+        try:
+            await optimize_db()
+        except Exception:
+            log.exception("PRAGMA optimize failed")
 
 
 async def on_startup(app):
+    app["db_pool"] = open_pool()
+    app["models_bytes"] = MODELS_FILE.read_bytes()
+    app["models_etag"] = hashlib.sha256(app["models_bytes"]).hexdigest()
+    app["index_bytes"] = (STATIC_DIR / "index.html").read_bytes()
+    app["index_etag"] = hashlib.sha256(app["index_bytes"]).hexdigest()
     await init_db()
+    app["endpoints_cache"] = {ep["id"]: ep for ep in await list_endpoints()}
+    app["endpoints_lock"] = asyncio.Lock()
     timeout = ClientTimeout(total=300)
-    app["client_session"] = ClientSession(timeout=timeout)
+    connector = TCPConnector(limit=256, limit_per_host=64, ttl_dns_cache=300, keepalive_timeout=60)
+    app["client_session"] = ClientSession(timeout=timeout, connector=connector)
+    app["optimize_task"] = asyncio.create_task(optimize_loop())
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    if request.method == "OPTIONS":
+        return web.Response()
+    return await handler(request)
+
+
+async def on_response_prepare(request, response):
+    # Done here rather than in cors_middleware so streamed and error responses get it too
+    response.headers.update(CORS_HEADERS)
+    if request.path.startswith("/static/") and response.status in (200, 304):
+        response.headers.setdefault("Cache-Control", STATIC_CACHE_CONTROL)
 
 
 async def on_cleanup(app):
+    app["optimize_task"].cancel()
     await app["client_session"].close()
+    await close_pool()
 
 
 def create_app():
-    app = web.Application(client_max_size=50 * 1024 * 1024)
+    app = web.Application(middlewares=[cors_middleware], client_max_size=50 * 1024 * 1024)
 
     app.on_startup.append(on_startup)
     app.on_cleanup.append(on_cleanup)
+    app.on_response_prepare.append(on_response_prepare)
 
     app.router.add_get("/", index_handler)
     app.router.add_get("/api/models", models_handler)
@@ -221,6 +352,7 @@ def create_app():
     app.router.add_get("/api/conversations/{id}/messages", messages_list_handler)
     app.router.add_post("/api/conversations/{id}/messages", messages_create_handler)
     app.router.add_delete("/api/conversations/{id}/messages/{msg_id}", messages_delete_handler)
+    app.router.add_get("/api/images/{hash}", images_handler)
 
     # System prompts library routes
     app.router.add_get("/api/prompts", prompts_list_handler)
@@ -235,23 +367,10 @@ def create_app():
 
     app.router.add_static("/static", STATIC_DIR, show_index=False)
 
-    cors = aiohttp_cors.setup(app, defaults={
-        "*": aiohttp_cors.ResourceOptions(
-            allow_credentials=True,
-            expose_headers="*",
-            allow_headers="*",
-            allow_methods="*",
-        )
-    })
-
-    for route in list(app.router.routes()):
-        try:
-            cors.add(route)
-        except ValueError:
-            pass
-
     return app
 
 
 if __name__ == "__main__":
-    web.run_app(create_app(), host="0.0.0.0", port=8083)
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    web.run_app(create_app(), host="0.0.0.0", port=8083, backlog=2048)
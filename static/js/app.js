@@ -490,14 +490,28 @@ createApp({
     },
 
     // ── Build request body (OpenAI Responses API for text, Chat Completions for image) ──
-    buildRequestBody() {
+    // Stored images come back as /api/images/{hash} URLs; upstream APIs need data URLs
+    async resolveImages(images) {
+      return Promise.all(images.map(async (url) => {
+        if (url.startsWith('data:')) return url;
+        const blob = await (await fetch(url)).blob();
+        return new Promise((resolve, reject) => {
+          const reader = new FileReader();
+          reader.onload = (e) => resolve(e.target.result);
+          reader.onerror = reject;
+          reader.readAsDataURL(blob);
+        });
+      }));
+    },
+
+    async buildRequestBody() {
       if (this.shouldUseChatCompletions()) {
         return this.buildChatCompletionsBody();
       }
       return this.buildResponsesBody();
     },
 
-    buildResponsesBody() {
+    async buildResponsesBody() {
       const input = [];
       if (this.systemPrompt.trim()) {
         input.push({ role: 'developer', content: [{ type: 'input_text', text: this.systemPrompt.trim() }] });
@@ -513,7 +527,7 @@ createApp({
             content.push({ type: 'input_text', text: msg.text });
           }
           if (msg.images && msg.images.length) {
-            for (const dataUrl of msg.images) {
+            for (const dataUrl of await this.resolveImages(msg.images)) {
               content.push({ type: 'input_image', image_url: dataUrl });
             }
           }
@@ -525,7 +539,7 @@ createApp({
       return { model: this.selectedModel, input };
     },
 
-    buildChatCompletionsBody() {
+    async buildChatCompletionsBody() {
       const messages = [];
       if (this.systemPrompt.trim()) {
         messages.push({ role: 'system', content: this.systemPrompt.trim() });
@@ -537,7 +551,7 @@ createApp({
             content.push({ type: 'text', text: msg.text });
           }
           if (msg.images && msg.images.length) {
-            for (const dataUrl of msg.images) {
+            for (const dataUrl of await this.resolveImages(msg.images)) {
               content.push({ type: 'image_url', image_url: { url: dataUrl } });
             }
           }
@@ -648,7 +662,7 @@ createApp({
       }, 100);
 
       try {
-        const body = this.buildRequestBody();
+        const body = await this.buildRequestBody();
         const endpoint = this.getApiEndpoint();
         const resp = await fetch(endpoint, {
           method: 'POST',